@@ -0,0 +1,54 @@
+# main.py のコンテキスト圧縮のしきい値 (CONTEXT_SIMILARITY_THRESHOLDS) を、
+# このナレッジに対する実測値から決めるためのスクリプト。
+# ナレッジや埋め込みモデルを変更したら実行し、出力の推奨値を main.py に設定する。
+#
+# 使い方 (venv 有効化後、functions ディレクトリで実行):
+#   set EMBEDDING_BACKEND=fastembed   (または openai。openai の場合は OPENAI_API_KEY も設定する)
+#   python calibrate_thresholds.py
+
+import os
+
+import numpy as np
+
+import main
+
+# 質問と、回答に必要なセクションの見出し (コンテキスト圧縮で残らなければならない)
+CONTEXT_CASES = [
+    ('名前を教えてください', '【RAGシステム運用ルール】'), ('年齢は？', '【RAGシステム運用ルール】'),
+    ('フォートナイトの経歴は？', '【フォートナイト分野】'), ('NEXUSに所属していましたか', '【フォートナイト分野】'),
+    ('経歴を教えて', '【IT分野】'), ('大手企業に転職したのはいつ？', '【IT分野】'),
+    ('作曲はできますか', '【芸術分野】'), ('C#の経験年数は？', '【プログラミング言語・フレームワーク】'),
+    ('Reactは使えますか', '【プログラミング言語・フレームワーク】'), ('納品経験を教えて', '【納品経験】'),
+]
+
+
+def run() -> None:
+    backend = main.EMBEDDING_BACKEND.value
+    embeddings = main._create_embeddings(os.environ.get('OPENAI_API_KEY', ''))
+    lines = [line for _, line in main.LINES]
+    line_vectors = main._normalize(embeddings.embed_documents(lines))
+    context = main._backend_threshold(main.CONTEXT_SIMILARITY_THRESHOLDS)
+    print(f"バックエンド：{backend} / CONTEXT={context}")
+
+    # セクションの類似度 = セクション内の行の類似度の最大値 (main._compress_context と同じ基準)
+    print("\n【回答に必要なセクションの類似度】")
+    section_ids = np.array(main.LINE_SECTION_IDS)
+    headers = {section_id: line for section_id, line in zip(main.LINE_SECTION_IDS, lines) if line.startswith('【')}
+    needed_scores = []
+    for query, header in CONTEXT_CASES:
+        scores = line_vectors @ main._normalize(embeddings.embed_query(query))
+        section_scores = {section_id: float(scores[section_ids == section_id].max()) for section_id in set(main.LINE_SECTION_IDS)}
+        needed = max(score for section_id, score in section_scores.items() if headers.get(section_id) == header)
+        needed_scores.append(needed)
+        dropped = sum(score < needed for score in section_scores.values())
+        mark = '  ※' if context is not None and needed < context else ''
+        print(f"{needed:.3f}  除外できるセクション={dropped}/{len(section_scores)}  {query}  →  {header}{mark}")
+    print(f"必要なセクションの最小値：{min(needed_scores):.3f}")
+
+    # 必要なセクションがすべて残る最大の値 (小数第 2 位で切り捨て)
+    print(f"\n【推奨値 ({backend})】")
+    print(f"CONTEXT_SIMILARITY_THRESHOLDS：{np.floor(min(needed_scores) * 100) / 100:.2f}")
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,21 @@
+# ローカル埋め込みモデル (fastembed / ONNX) を functions/models にダウンロードする。
+# ローカル (エミュレータ) で EMBEDDING_BACKEND=fastembed を使うときに実行しておくと、起動のたびにダウンロードしない。
+# functions/models はデプロイ対象外 (約 220MB あり、ソースのアップロード上限を超えるため。firebase.json の ignore 参照)。
+#
+# 使い方 (venv 有効化後、functions ディレクトリで実行):
+#   python download_model.py
+
+import os
+
+from fastembed import TextEmbedding
+
+# main.py と同じモデル・同じ場所 (functions/models) を使う
+from embedding_model import FASTEMBED_MODEL_NAME, BUNDLED_MODEL_DIR
+
+
+if __name__ == '__main__':
+    os.makedirs(BUNDLED_MODEL_DIR, exist_ok=True)
+    model = TextEmbedding(model_name=FASTEMBED_MODEL_NAME, cache_dir=BUNDLED_MODEL_DIR)
+    # ダウンロードしたモデルで推論できることを確認する
+    dim = len(next(iter(model.embed(['動作確認']))))
+    print(f"ダウンロード完了：{FASTEMBED_MODEL_NAME} ({dim} 次元) → {BUNDLED_MODEL_DIR}")
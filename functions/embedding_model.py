@@ -0,0 +1,12 @@
+# ローカル埋め込みモデル (fastembed) の設定。
+# main.py (推論) と download_model.py (ローカル用のダウンロード) の両方から参照し、
+# ダウンロードしたモデルと推論に使うモデルが食い違わないようにする。
+
+import os
+
+# ナレッジが日本語のため、多言語対応の小型モデル (384 次元、約 220MB) を用いる
+# fastembed が対応する多言語モデルではこれが最小 (bge-small 等の小型モデルは英語・中国語のみ)
+FASTEMBED_MODEL_NAME = 'sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2'
+
+# ダウンロードしたモデルの置き場所 (functions/models, デプロイ対象外)
+BUNDLED_MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models')
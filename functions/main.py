@@ -1,78 +1,98 @@
+import asyncio
+import functools
+import hashlib
+import logging
 import os
+import shutil
+import threading
+import time
 from http import HTTPStatus
-from flask import jsonify
+from typing import NamedTuple
+import orjson
+from cachetools import LRUCache, TTLCache
+import httpx
+
+import faiss
+import numpy as np
+import openai
 
 # LangChainの主要コンポーネントをインポート
-from langchain_community.vectorstores import DocArrayInMemorySearch
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+from langchain_community.retrievers import BM25Retriever
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.messages import BaseMessage
+from langchain_community.embeddings import FastEmbedEmbeddings
 from langchain_openai import OpenAIEmbeddings, ChatOpenAI
-from langchain.text_splitter import CharacterTextSplitter
-from langchain.prompts import ChatPromptTemplate
-from langchain.chains.retrieval import create_retrieval_chain
-from langchain.chains.combine_documents import create_stuff_documents_chain
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_text_splitters import CharacterTextSplitter
+from pydantic import BaseModel, PrivateAttr
 
 from firebase_admin import initialize_app
-from firebase_functions.options import set_global_options, CorsOptions
-from flask import Flask, jsonify
+from firebase_functions.options import set_global_options, CorsOptions, MemoryOption
 from firebase_functions import params, https_fn
+from google.cloud import logging as cloud_logging
 
-# Flaskの定義 (jsonifyを使うために残します)
-app = Flask(__name__)
+from embedding_model import FASTEMBED_MODEL_NAME, BUNDLED_MODEL_DIR
 
 # --- Firebase Admin SDKの初期化 ---
 initialize_app()
 
-# 関数のグローバルオプションを設定（例：最大インスタンス数）
-set_global_options(max_instances=10)
+# --- ロギングの設定 ---
+# Cloud Functions 上では Cloud Logging の構造化ログに流し、ローカル (エミュレータ) では標準出力に出す
+# ログレベルは環境変数 LOG_LEVEL で切り替える (本番は INFO を想定)
+# 'debug' のような小文字や不正な値でも起動に失敗しないよう、大文字に正規化し、不正なら INFO とする
+_LOG_LEVEL = logging.getLevelName(os.environ.get('LOG_LEVEL', 'INFO').strip().upper())
+if not isinstance(_LOG_LEVEL, int):
+    _LOG_LEVEL = logging.INFO
+if os.environ.get('K_SERVICE'):
+    cloud_logging.Client().setup_logging(log_level=_LOG_LEVEL)
+else:
+    logging.basicConfig(level=_LOG_LEVEL)
+logger = logging.getLogger(__name__)
 
 # 固定 CORS ヘッダーの定義
 CORS_HEADERS = {
     'Access-Control-Allow-Origin': '*',  # すべてのオリジンを許可
     'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
     'Access-Control-Allow-Headers': 'Content-Type, Authorization',
-    'Access-Control-Max-Age': '3600',  # プリフライト結果をキャッシュする秒数
+    'Access-Control-Max-Age': '86400',  # プリフライト結果をキャッシュする秒数 (1 日)
 }
 
 # 1. APIキーを環境変数から取得し設定
 # SecretParam オブジェクトは関数の外で定義する (変更なし)
 OPENAI_API_KEY = params.SecretParam('OPENAI_API_KEY') # ★ SecretParam を利用
 
-# --- ヘルパー関数 ---
+# ベクトル化に使うバックエンド ('openai': OpenAI Embeddings API / 'fastembed': ローカル CPU モデル)
+# 日本語に対応する fastembed のモデルは最小でも約 220MB あり、デプロイ物に同梱すると
+# Cloud Functions のソースのアップロード上限 (圧縮後 100MB) を超えるため、既定は 'openai' とする
+EMBEDDING_BACKEND = params.StringParam('EMBEDDING_BACKEND', default='openai')
 
-def create_response(response):
-    """
-    レスポンスオブジェクトに CORS ヘッダーを適用する。
-    Flask Response または https_fn.Response に対応。
-    """
-    # Note: 'Content-Type' は jsonify が既に設定しているため、ここでは CORS 関連のみを更新
-    response.headers.update(CORS_HEADERS)
-    return response
+# 関数のグローバルオプションを設定（例：最大インスタンス数）
+# fastembed の場合は、/tmp (メモリ上) に置くモデルと onnxruntime のため、既定の 256MiB から増やす
+set_global_options(
+    max_instances=10,
+    memory=EMBEDDING_BACKEND.equals('fastembed').then(MemoryOption.GB_1.value, MemoryOption.MB_256.value),
+)
 
+# ローカル埋め込みモデルの設定 (モデル名と置き場所は download_model.py と共有する)
+# functions/models はデプロイ対象外 (firebase.json の ignore) のため、ローカル (エミュレータ) でのみ使われる
+# デプロイ先ではコールドスタート時に /tmp にダウンロードする
+FASTEMBED_CACHE_DIR = BUNDLED_MODEL_DIR if os.path.isdir(BUNDLED_MODEL_DIR) else '/tmp/fastembed'
 
-# Cloud FunctionsのHTTPトリガーを定義
-@https_fn.on_request(secrets=["OPENAI_API_KEY"])  # ★ cors=CorsOptions(...) の引数を削除
-def rag_api_handler(request: https_fn.Request) -> tuple[https_fn.Response, int] | https_fn.Response:
-    # 1. OPTIONS (プリフライトリクエスト) のハンドリング
-    if request.method == 'OPTIONS':
-        return create_response(
-            https_fn.Response('', status=HTTPStatus.NO_CONTENT)
-        )
+# 質問文のベクトルをキャッシュする件数 (埋め込みモデルのインスタンスごと)
+QUERY_EMBEDDING_CACHE_SIZE = 2048
 
-    # ★ 2. APIキーが存在しない場合のチェックと強制終了
-    openai_api_key = OPENAI_API_KEY.value
-    print(f"APIキー：{openai_api_key}")
-    if not openai_api_key:
-        error_response = jsonify({'error': 'OpenAI API Key (OPENAI_API_KEY) not set in environment.'})
-        # ★ エラー応答も必ず create_response を通し、CORSヘッダーを付与する
-        return create_response(error_response), HTTPStatus.INTERNAL_SERVER_ERROR
+# OpenAI Embeddings API の 1 リクエストあたりにまとめるチャンク数
+# 全チャンクを 1 回の POST /v1/embeddings (input=[...]) でベクトル化する
+OPENAI_EMBEDDING_BATCH_SIZE = 1000
 
-    # 3. リクエストから質問（query）を取得
-    request_json = request.get_json(silent=True)
-    user_query = request_json.get('prompt', 'Firebase FunctionsのRAGについて教えてください。')  # 'prompt'を使用
-
-    # --- RAGの「事前準備」ステップ ---
-
-    # 4. ナレッジベースの定義
-    knowledge_text = """
+# --- ナレッジベースの定義 ---
+# ナレッジは静的なため、モジュールスコープに置いてリクエスト間で共有する
+KNOWLEDGE_TEXT = """
     【RAGシステム運用ルール】
 名前:三好 智(みよし あきら)
 性別:男
@@ -132,26 +152,404 @@ GitHub 経験年数 : 6年
 ・人材系大手企業システム
 ・教育系大手企業システム
 ・物流系大手企業システム
+"""
+
+# ナレッジのチャンク分割はインポート時に一度だけ行う (リクエスト処理からは除外)
+DOCS: list[str] = CharacterTextSplitter(chunk_size=500, chunk_overlap=0).split_text(KNOWLEDGE_TEXT)
+_DOC_IDS = {doc: i for i, doc in enumerate(DOCS)}
+
+# コンテキスト圧縮用に、各チャンクを (チャンクの位置, 行) の組に分割しておく (空行は除く)
+LINES: list[tuple[int, str]] = [
+    (i, line.strip()) for i, doc in enumerate(DOCS) for line in doc.splitlines() if line.strip()
+]
+
+
+def _section_ids(lines: list[tuple[int, str]]) -> list[int]:
+    """
+    各行が属するセクションの番号を返す。
+    セクションは 【…】 の見出し行、またはチャンクの先頭から始まる (見出しのない冒頭もひとつのセクションとする)。
+    """
+    section_ids: list[int] = []
+    section_id, prev_doc_id = -1, -1
+    for doc_id, line in lines:
+        if doc_id != prev_doc_id or line.startswith('【'):
+            section_id += 1
+        section_ids.append(section_id)
+        prev_doc_id = doc_id
+    return section_ids
+
+
+# コンテキスト圧縮で見出しと本文を切り離さないよう、行をセクション単位でまとめて扱う
+LINE_SECTION_IDS: list[int] = _section_ids(LINES)
+
+# HNSW 索引の設定
+# チャンク数が少ない場合は HNSW のオーバーヘッドに見合わないため、全件走査 (int8) にフォールバックする
+HNSW_MIN_DOCS = 64
+HNSW_M = 16
+HNSW_EF_SEARCH = 64
+
+# 構築済みのベクトル索引の保存先
+# /tmp はコンテナ内で保持されるため、同一コンテナでの再初期化時はベクトル化を省略できる
+INDEX_CACHE_DIR = '/tmp/kb_index'
+
+# LLM 呼び出しのタイムアウトとリトライ設定
+# 平均応答時間より少し長めのタイムアウトで打ち切り、外れ値はリトライで救う
+# リトライは _execute_with_backoff_async の 1 層だけで行う (SDK 側でもリトライすると、
+# SDK のリトライが ANSWER_TIMEOUT 内に収まらず外側のタイムアウトで必ず打ち切られるため)
+LLM_REQUEST_TIMEOUT = 10  # OpenAI API 1 回あたりのタイムアウト (秒)
+LLM_MAX_RETRIES = 0  # OpenAI SDK 内部のリトライ回数 (外側でリトライするため 0)
+ANSWER_TIMEOUT = 12  # 検索 + 回答生成全体のタイムアウト (秒, LLM_REQUEST_TIMEOUT より長く取る)
+ANSWER_RETRY_DELAYS = (1, 2)  # タイムアウト時のリトライ待機時間 (指数バックオフ, 秒)
+ANSWER_TIMEOUT_ERROR = 'Timed out while generating the answer.'
+ANSWER_GENERATION_ERROR = 'Failed while generating the answer.'
+# リトライ対象の例外 (すべて失敗した場合は 504 で返す)
+# SDK のタイムアウト (LLM_REQUEST_TIMEOUT) は外側の ANSWER_TIMEOUT より先に発生し、
+# TimeoutError ではなく openai.APITimeoutError (APIConnectionError のサブクラス) になるため併せて捕捉する
+ANSWER_RETRY_ERRORS = (TimeoutError, openai.APIConnectionError)
+# 索引構築時の OpenAI Embeddings API のリトライ回数 (リクエスト処理の外で実行されるため SDK に任せる)
+EMBEDDING_MAX_RETRIES = 2
+
+# コンテキスト圧縮の設定
+# 検索したチャンクを 【…】 のセクション単位に分け、質問との類似度がしきい値以上の行を含むセクションだけを LLM に渡す
+# (行単位で残すと「〈経歴〉」のような見出しだけが残り、回答に必要な本文が落ちるため)
+# 行のベクトルはチェーン構築時に一度だけ計算し、リクエストごとには質問ベクトルとの内積のみを取る
+# 類似度の分布は埋め込みモデルごとに異なるため、しきい値はバックエンド別に持つ
+# 値は calibrate_thresholds.py の推奨値を設定する。None は未計測を表し、圧縮せずにチャンク全体を渡す。
+CONTEXT_SIMILARITY_THRESHOLDS: dict[str, float | None] = {'openai': None, 'fastembed': None}
+
+# 複数質問の一括処理 ('queries') の上限件数と、同時に実行する RAG の数
+MAX_BATCH_QUERIES = 16
+BATCH_MAX_CONCURRENCY = 4
+
+# ストリーミング応答で、細かいトークンをまとめて送出する間隔 (秒)
+STREAM_FLUSH_INTERVAL = 0.05
+
+# RAG チェーンの初期化を直列化するためのロック (同一コンテナ内の並行リクエスト対策)
+_CHAIN_LOCK = threading.Lock()
+
+# OpenAI API 用の共有 HTTP クライアント (HTTP/2 + keep-alive)
+# コンテナ内で一度だけ生成し、TLS ハンドシェイクと TCP 接続をリクエスト間で使い回す
+_HTTP_LIMITS = httpx.Limits(max_keepalive_connections=20)
+_HTTP_CLIENT = httpx.Client(http2=True, limits=_HTTP_LIMITS, timeout=15.0)
+_HTTP_ASYNC_CLIENT = httpx.AsyncClient(http2=True, limits=_HTTP_LIMITS, timeout=15.0)
+
+# 非同期処理を実行する常駐イベントループ
+# 非同期クライアントの接続はイベントループに紐づくため、リクエストごとに
+# asyncio.run で新しいループを作らず、同じループ上で実行する
+_EVENT_LOOP = asyncio.new_event_loop()
+threading.Thread(target=_EVENT_LOOP.run_forever, name='rag-event-loop', daemon=True).start()
+
+
+def _normalize(vector) -> np.ndarray:
+    """ベクトルを L2 正規化する (正規化済みベクトル同士の内積 = コサイン類似度)。"""
+    array = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(array, axis=-1, keepdims=True)
+    return np.divide(array, norm, out=np.zeros_like(array), where=norm != 0)
+
+
+class QueryCache:
+    """
+    正規化した質問文をキーに回答をキャッシュする、スレッドセーフな TTL 付き LRU キャッシュ。
+    ヒット数・ミス数・追い出し数を記録し、/cache_stats で参照できるようにする。
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: int = 300):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        return query.strip().lower()
+
+    def get(self, query: str):
+        key = self.normalize(query)
+        with self._lock:
+            value = self._cache.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def set(self, query: str, value: dict) -> None:
+        key = self.normalize(query)
+        with self._lock:
+            # 容量超過で LRU の項目が追い出される場合のみカウントする (期限切れは除く)
+            self._cache.expire()
+            if key not in self._cache and len(self._cache) >= self._cache.maxsize:
+                self.evictions += 1
+            self._cache[key] = value
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._cache),
+                'maxsize': self._cache.maxsize,
+                'ttl': self._cache.ttl,
+            }
+
+
+# 質問文 → 回答 のキャッシュ (同一の質問には RAG を再実行せずに即答する)
+_ANSWER_CACHE = QueryCache(maxsize=1024, ttl=300)
+
+
+class _QueryEmbeddingCacheMixin(BaseModel):
+    """
+    質問文のベクトル化結果を LRU でキャッシュする Embeddings 用ミックスイン。
+    同じ質問文であれば埋め込みモデルの呼び出しを省略する。
+    キャッシュはインスタンスごとに持つ (クラス共有にすると、作り直した古いインスタンスがキャッシュから参照され続けるため)。
+    """
+
+    _query_cache: LRUCache = PrivateAttr(default_factory=lambda: LRUCache(maxsize=QUERY_EMBEDDING_CACHE_SIZE))
+    _query_cache_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def embed_query(self, text: str) -> list[float]:
+        with self._query_cache_lock:
+            vector = self._query_cache.get(text)
+        if vector is None:
+            vector = tuple(super().embed_query(text))
+            with self._query_cache_lock:
+                self._query_cache[text] = vector
+        return list(vector)
+
+    async def aembed_query(self, text: str) -> list[float]:
+        # 非同期経路でも同じキャッシュを使うため、同期版をスレッドで実行する
+        return await asyncio.to_thread(self.embed_query, text)
+
+
+class CachedOpenAIEmbeddings(_QueryEmbeddingCacheMixin, OpenAIEmbeddings):
+    """質問文のベクトルをキャッシュする OpenAIEmbeddings。"""
+
+
+class CachedFastEmbedEmbeddings(_QueryEmbeddingCacheMixin, FastEmbedEmbeddings):
+    """質問文のベクトルをキャッシュする、ローカル CPU 推論の FastEmbedEmbeddings。"""
+
+
+def _create_embeddings(api_key: str):
+    """
+    EMBEDDING_BACKEND に応じた Embeddings を生成する。
+    'fastembed' の場合はローカルモデルを使い、OpenAI への通信とトークン課金を発生させない。
+    """
+    if EMBEDDING_BACKEND.value == 'openai':
+        return CachedOpenAIEmbeddings(
+            api_key=api_key,
+            http_client=_HTTP_CLIENT,
+            http_async_client=_HTTP_ASYNC_CLIENT,
+            chunk_size=OPENAI_EMBEDDING_BATCH_SIZE,
+            max_retries=EMBEDDING_MAX_RETRIES,
+        )
+    if FASTEMBED_CACHE_DIR != BUNDLED_MODEL_DIR:
+        logger.info("埋め込みモデルを /tmp にダウンロードします：%s", FASTEMBED_MODEL_NAME)
+    return CachedFastEmbedEmbeddings(model_name=FASTEMBED_MODEL_NAME, cache_dir=FASTEMBED_CACHE_DIR)
+
+
+class RagChain(NamedTuple):
+    """検索元 (複数可) と、検索結果から回答を生成する LLM・プロンプトの組。"""
+    retrievers: list[BaseRetriever]
+    llm: ChatOpenAI
+    prompt: ChatPromptTemplate
+    embeddings: Embeddings
+    lines: list[str]  # チャンクを行単位に分割したもの (コンテキスト圧縮用)
+    line_doc_ids: np.ndarray  # 各行が属するチャンクの DOCS 上の位置
+    line_section_ids: np.ndarray  # 各行が属するセクションの番号
+    line_vectors: np.ndarray | None  # 各行の正規化済みベクトル (コンテキスト圧縮が無効なら None)
+
+
+class AnswerError(Exception):
+    """回答の生成に失敗したことを表す例外。応答に含めるエラーメッセージと HTTP ステータスを持つ。"""
+
+    def __init__(self, error: str, status: HTTPStatus):
+        super().__init__(error)
+        self.error = error
+        self.status = status
+
+
+def _bigram_tokenize(text: str) -> list[str]:
+    """
+    BM25 用のトークナイザ。日本語は空白で分割できないため、文字 bi-gram を用いる。
+    """
+    text = "".join(text.split())
+    return [text[i:i + 2] for i in range(len(text) - 1)]
+
+
+# --- ヘルパー関数 ---
+
+def _build_vectorstore(docs: list[str], embeddings):
+    """
+    チャンクをベクトル化し、FAISS のベクトルストアを構築する。
+    ベクトルは int8 にスカラー量子化して保持する (FP32 比でメモリ 1/4)。
+    チャンク数が HNSW_MIN_DOCS 以上なら HNSW 索引 (近似最近傍探索)、
+    それ未満なら全件走査を用いる。
+    """
+    vectors = embeddings.embed_documents(docs)
+    dim = len(vectors[0])
+    # 正規化したベクトルの内積 = コサイン類似度
+    if len(docs) < HNSW_MIN_DOCS:
+        index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+    else:
+        index = faiss.IndexHNSWSQ(dim, faiss.ScalarQuantizer.QT_8bit, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+
+    # 量子化の範囲 (次元ごとの min/max) を、格納時と同じ正規化済みベクトルから学習する
+    training = np.array(vectors, dtype=np.float32)
+    faiss.normalize_L2(training)
+    index.train(training)
+
+    vectorstore = FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=InMemoryDocstore(),
+        index_to_docstore_id={},
+        normalize_L2=True,
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+    )
+    vectorstore.add_embeddings(list(zip(docs, vectors)))
+    return vectorstore
+
+
+def _index_dir(docs: list[str]) -> str:
+    """
+    ベクトル索引の保存先を返す。
+    ナレッジや埋め込みモデル、索引の設定が変わると別のパスになり、古い索引は使われない。
+    """
+    key = "\n".join([EMBEDDING_BACKEND.value, FASTEMBED_MODEL_NAME, str(HNSW_MIN_DOCS), str(HNSW_M), *docs])
+    return os.path.join(INDEX_CACHE_DIR, hashlib.sha256(key.encode('utf-8')).hexdigest()[:16])
+
+
+def _load_or_build_vectorstore(docs: list[str], embeddings):
+    """
+    /tmp に保存済みのベクトル索引があれば読み込み、なければ構築して保存する。
+    """
+    path = _index_dir(docs)
+    load_failed = False
+    if os.path.exists(os.path.join(path, 'index.faiss')):
+        try:
+            vectorstore = FAISS.load_local(
+                path,
+                embeddings,
+                # 自身が /tmp に保存した索引のみを読み込む
+                allow_dangerous_deserialization=True,
+                normalize_L2=True,
+                distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+            )
+            if isinstance(vectorstore.index, faiss.IndexHNSW):
+                vectorstore.index.hnsw.efSearch = HNSW_EF_SEARCH
+            return vectorstore
+        except Exception as e:
+            logger.warning("索引の読み込み失敗：%r", e)
+            load_failed = True
+
+    vectorstore = _build_vectorstore(docs, embeddings)
+
+    # 別プロセスが読み込み途中の索引を見ないよう、一時ディレクトリに書いてから置き換える
+    # 読み込めなかった (壊れた) 索引が残っていると置き換えに失敗するため、先に削除する
+    # 削除はこのプロセスが読み込みに失敗した場合に限る (並行して構築した別プロセスの索引を消さないため。
+    # その場合は置き換えに失敗し、先に保存された索引が残る)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        vectorstore.save_local(tmp_path)
+        if load_failed:
+            shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning("索引の保存失敗：%r", e)
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    return vectorstore
+
+
+def _load_or_build_line_vectors(lines: list[str], embeddings) -> np.ndarray:
+    """
+    行単位のベクトル (正規化済み) を返す。
+    ベクトル索引と同じく /tmp に保存し、保存済みであれば再計算しない。
     """
+    path = f"{_index_dir(DOCS)}-lines.npy"
+    if os.path.exists(path):
+        try:
+            vectors = np.load(path)
+            if vectors.shape[0] == len(lines):
+                return vectors
+        except (OSError, ValueError) as e:
+            logger.warning("行ベクトルの読み込み失敗：%r", e)
 
-    # 5. データの前処理とベクトル化
-    text_splitter = CharacterTextSplitter(chunk_size=500, chunk_overlap=0)
-    docs = text_splitter.split_text(knowledge_text)
+    # 全行を 1 回の embed_documents でまとめてベクトル化する
+    vectors = _normalize(embeddings.embed_documents(lines))
+    tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+    try:
+        os.makedirs(INDEX_CACHE_DIR, exist_ok=True)
+        np.save(tmp_path, vectors)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning("行ベクトルの保存失敗：%r", e)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return vectors
 
-    # テキストをベクトル化し、メモリ内のベクトルストアに保存（PoC向け）
-    embeddings = OpenAIEmbeddings(api_key=openai_api_key)
-    vectorstore = DocArrayInMemorySearch.from_texts(docs, embeddings)
+
+def _run_async(coro):
+    """常駐イベントループ上でコルーチンを実行し、結果を待って返す。"""
+    return asyncio.run_coroutine_threadsafe(coro, _EVENT_LOOP).result()
+
+
+def json_response(data) -> https_fn.Response:
+    """
+    orjson でシリアライズした JSON レスポンスを生成する (標準の json より高速)。
+    """
+    return https_fn.Response(orjson.dumps(data), mimetype='application/json')
+
+
+def parse_json(request: https_fn.Request):
+    """
+    リクエストボディを orjson でパースする。
+    不正な JSON の場合は None を返す (request.get_json(silent=True) と同じ扱い)。
+    """
+    try:
+        return orjson.loads(request.get_data())
+    except orjson.JSONDecodeError:
+        return None
+
+
+def create_response(response):
+    """
+    レスポンスオブジェクトに CORS ヘッダーを適用する。
+    Flask Response または https_fn.Response に対応。
+    """
+    # Note: 'Content-Type' は json_response が既に設定しているため、ここでは CORS 関連のみを更新
+    response.headers.update(CORS_HEADERS)
+    return response
+
+
+@functools.lru_cache(maxsize=1)
+def _build_chain(api_key: str):
+    """
+    RAG チェーンを構築する。
+    ウォームなコンテナでは一度だけ構築され、以降の呼び出しで再利用される。
+    """
+    # --- RAGの「事前準備」ステップ ---
+
+    # テキストをベクトル化し、メモリ内のベクトルストアに保存 (チャンクは DOCS を使用)
+    embeddings = _create_embeddings(api_key)
+    vectorstore = _load_or_build_vectorstore(DOCS, embeddings)
 
     # --- RAGの「実行」ステップ ---
 
-    # 6. LLMの準備
+    # LLMの準備
     llm = ChatOpenAI(
         model="gpt-3.5-turbo",
         temperature=0.0,
-        api_key=openai_api_key
+        api_key=api_key,
+        request_timeout=LLM_REQUEST_TIMEOUT,
+        max_retries=LLM_MAX_RETRIES,
+        http_client=_HTTP_CLIENT,
+        http_async_client=_HTTP_ASYNC_CLIENT,
     )
 
-    # 7. プロンプトテンプレートの定義
+    # プロンプトテンプレートの定義
     prompt = ChatPromptTemplate.from_messages(
         [
             ("system",
@@ -160,25 +558,316 @@ GitHub 経験年数 : 6年
         ]
     )
 
-    # 8. RAGチェーンの構築
-    document_chain = create_stuff_documents_chain(llm, prompt)
-    retriever = vectorstore.as_retriever()
-    retrieval_chain = create_retrieval_chain(retriever, document_chain)
+    # RAGチェーンの構築
+    # ベクトル検索とキーワード検索 (BM25) の 2 系統を並列に検索する
+    retrievers = [
+        vectorstore.as_retriever(),
+        BM25Retriever.from_texts(DOCS, preprocess_func=_bigram_tokenize),
+    ]
+
+    # コンテキスト圧縮 (質問と関係の薄いセクションを除外) 用に、行のベクトルを一度だけ計算しておく
+    # しきい値が未計測 (None) で圧縮しない場合は、行のベクトル化 (OpenAI なら API 呼び出し) を省く
+    lines = [line for _, line in LINES]
+    line_vectors = None
+    if _backend_threshold(CONTEXT_SIMILARITY_THRESHOLDS) is not None:
+        line_vectors = _load_or_build_line_vectors(lines, embeddings)
+    return RagChain(
+        retrievers=retrievers,
+        llm=llm,
+        prompt=prompt,
+        embeddings=embeddings,
+        lines=lines,
+        line_doc_ids=np.array([doc_id for doc_id, _ in LINES]),
+        line_section_ids=np.array(LINE_SECTION_IDS),
+        line_vectors=line_vectors,
+    )
+
+
+def _get_chain(api_key: str) -> RagChain:
+    """
+    キャッシュ済みの RAG チェーンを取得する。
+    初回構築が並行して走らないようロックで保護する。
+    """
+    with _CHAIN_LOCK:
+        return _build_chain(api_key)
+
+
+async def parallel_retrieve(retrievers: list[BaseRetriever], query: str) -> list[Document]:
+    """
+    複数の検索元へ並列に問い合わせ、重複を除いた結果を返す。
+    レイテンシは各検索元の合計ではなく最大値になる。
+    一部の検索元が失敗しても、残りの結果で回答を続行する。
+    """
+    tasks = [asyncio.create_task(retriever.ainvoke(query)) for retriever in retrievers]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+
+    docs: list[Document] = []
+    seen: set[str] = set()
+    for result in results:
+        if isinstance(result, BaseException):
+            logger.warning("検索失敗：%r", result)
+            continue
+        for doc in result:
+            if doc.page_content not in seen:
+                seen.add(doc.page_content)
+                docs.append(doc)
+    return docs
+
+
+def _backend_threshold(thresholds: dict[str, float | None]) -> float | None:
+    """EMBEDDING_BACKEND に対応するしきい値を返す (未計測なら None)。"""
+    return thresholds.get(EMBEDDING_BACKEND.value, thresholds['fastembed'])
+
+
+def _compress_context(rag_chain: RagChain, query_vector: list[float], docs: list[Document]) -> list[Document]:
+    """
+    検索結果から質問と関係の薄いセクションを取り除く。
+    しきい値以上の行を 1 つでも含むセクションは、見出しを含めてセクション全体を残す。
+    行のベクトルは構築済みのため、質問ベクトルとの内積を取るだけで埋め込みモデルは呼ばない。
+    圧縮が無効な場合 (行のベクトルがない・しきい値が未計測) や、すべてのセクションが除外された場合は、
+    元の検索結果をそのまま使う。
+    """
+    threshold = _backend_threshold(CONTEXT_SIMILARITY_THRESHOLDS)
+    if rag_chain.line_vectors is None or threshold is None:
+        return docs
+    relevant = (rag_chain.line_vectors @ _normalize(query_vector)) >= threshold
+    relevant = np.isin(rag_chain.line_section_ids, rag_chain.line_section_ids[relevant])
+
+    compressed: list[Document] = []
+    for doc in docs:
+        keep = relevant & (rag_chain.line_doc_ids == _DOC_IDS.get(doc.page_content, -1))
+        if keep.any():
+            content = "\n".join(rag_chain.lines[i] for i in np.flatnonzero(keep))
+            compressed.append(Document(page_content=content, metadata=doc.metadata))
+    return compressed or docs
+
+
+def _format_messages(rag_chain: RagChain, query: str, docs: list[Document]) -> list[BaseMessage]:
+    """
+    検索結果をコンテキストとしてプロンプトに埋め込む。
+    LangChain のチェーンを介さず直接組み立て、実行時のオーバーヘッドを省く。
+    """
+    context = "\n\n".join(doc.page_content for doc in docs)
+    return rag_chain.prompt.format_messages(context=context, input=query)
+
+
+async def _answer_async(rag_chain: RagChain, query: str) -> tuple[str, list[Document]]:
+    """
+    検索と回答生成を非同期に実行し、(回答, 参照ドキュメント) を返す。
+    """
+    context = await parallel_retrieve(rag_chain.retrievers, query)
+    compressed = context
+    # 質問のベクトル化はコンテキスト圧縮にのみ使うため、圧縮が無効なら省く
+    if rag_chain.line_vectors is not None:
+        query_vector = await rag_chain.embeddings.aembed_query(query)
+        compressed = _compress_context(rag_chain, query_vector, context)
+    message = await rag_chain.llm.ainvoke(_format_messages(rag_chain, query, compressed))
+    return message.content, context
+
+
+async def _execute_with_backoff_async(coro_factory, timeout: float, retry_delays=ANSWER_RETRY_DELAYS):
+    """
+    coro_factory() が返すコルーチンをタイムアウト付きで実行する。
+    タイムアウト・接続エラー (ANSWER_RETRY_ERRORS) の場合は retry_delays の間隔で再実行し、
+    すべて失敗したら最後の例外を送出する。
+    """
+    for delay in (*retry_delays, None):
+        try:
+            return await asyncio.wait_for(coro_factory(), timeout=timeout)
+        except ANSWER_RETRY_ERRORS as e:
+            if delay is None:
+                raise
+            logger.warning("タイムアウト (%r)：%s秒後にリトライします", e, delay)
+            await asyncio.sleep(delay)
+
+
+def _lookup_answer(api_key: str, query: str) -> tuple[dict | None, RagChain | None]:
+    """
+    回答キャッシュを確認する。(回答, RAG チェーン) を返す。
+    - 回答キャッシュにあれば、チェーンを構築せずにその回答を返す
+    - なければ (None, チェーン) を返すので、_generate_answer_async 等で生成する
+    """
+    cached = _ANSWER_CACHE.get(query)
+    if cached is not None:
+        return cached, None
+    return None, _get_chain(api_key)
+
+
+async def _generate_answer_async(rag_chain: RagChain, query: str) -> dict:
+    """
+    RAG で回答を生成し、キャッシュに登録して返す。
+    タイムアウト時はリトライする。失敗した場合は、応答に使うメッセージと HTTP ステータスを持つ
+    AnswerError を送出する (単一・一括の両方の経路で同じ扱いにするため)。
+    """
+    try:
+        answer, context = await _execute_with_backoff_async(
+            lambda: _answer_async(rag_chain, query), timeout=ANSWER_TIMEOUT
+        )
+    except ANSWER_RETRY_ERRORS as e:
+        raise AnswerError(ANSWER_TIMEOUT_ERROR, HTTPStatus.GATEWAY_TIMEOUT) from e
+    except openai.OpenAIError as e:
+        logger.warning("回答の生成失敗：%r", e)
+        raise AnswerError(ANSWER_GENERATION_ERROR, HTTPStatus.BAD_GATEWAY) from e
+    cached = {
+        'answer': answer,
+        # 参照元ドキュメント（今回はコード内のナレッジ）
+        'source_documents_count': len(context),
+    }
+    _ANSWER_CACHE.set(query, cached)
+    return cached
+
+
+async def _answer_queries_async(api_key: str, queries: list[str]) -> list[dict]:
+    """
+    複数の質問を並行して処理し、質問ごとの結果を入力と同じ順序で返す。
+    単一の質問と同じ手順 (_lookup_answer → _generate_answer_async) で回答し、
+    RAG の同時実行数は BATCH_MAX_CONCURRENCY に制限する。
+    タイムアウトや OpenAI API のエラーで失敗した質問は、一括処理全体を失敗させずに
+    その質問だけをエラーとして返す。
+    """
+    semaphore = asyncio.Semaphore(BATCH_MAX_CONCURRENCY)
+
+    async def answer_one(query: str) -> dict:
+        cached, rag_chain = await asyncio.to_thread(_lookup_answer, api_key, query)
+        if cached is None:
+            async with semaphore:
+                try:
+                    cached = await _generate_answer_async(rag_chain, query)
+                except AnswerError as e:
+                    return {'query': query, 'error': e.error, 'status': 'error'}
+        return {'query': query, **cached, 'status': 'success'}
+
+    return await asyncio.gather(*(answer_one(query) for query in queries))
+
+
+def _sse(data: dict) -> bytes:
+    """Server-Sent Events の 1 フレームを組み立てる。"""
+    return b"data: " + orjson.dumps(data) + b"\n\n"
+
+
+def _stream_answer(rag_chain: RagChain | None, query: str, cached: dict | None):
+    """
+    回答を SSE で逐次送出するジェネレータ。
+    トークンは STREAM_FLUSH_INTERVAL ごとにまとめて送り、最後に参照ドキュメント数を送る。
+    キャッシュ済みの回答があれば、それを 1 フレームで送出する。
+    途中で失敗した場合は 'status': 'error' の最終フレームを送る。
+    """
+    # ヘッダー (200) の送出後に発生した例外は HTTP ステータスで返せないため、
+    # エラーのフレームを送って終了を通知する
+    try:
+        if cached is None:
+            context = _run_async(parallel_retrieve(rag_chain.retrievers, query))
+            compressed = context
+            if rag_chain.line_vectors is not None:
+                compressed = _compress_context(rag_chain, rag_chain.embeddings.embed_query(query), context)
+            parts: list[str] = []
+            buffer: list[str] = []
+            last_flush = time.monotonic()
+            for chunk in rag_chain.llm.stream(_format_messages(rag_chain, query, compressed)):
+                parts.append(chunk.content)
+                buffer.append(chunk.content)
+                if time.monotonic() - last_flush >= STREAM_FLUSH_INTERVAL:
+                    yield _sse({'answer': "".join(buffer)})
+                    buffer.clear()
+                    last_flush = time.monotonic()
+            if buffer:
+                yield _sse({'answer': "".join(buffer)})
+
+            cached = {'answer': "".join(parts), 'source_documents_count': len(context)}
+            _ANSWER_CACHE.set(query, cached)
+        else:
+            yield _sse({'answer': cached['answer']})
+    except Exception:
+        logger.exception("ストリーミング応答の生成失敗")
+        yield _sse({'query': query, 'status': 'error', 'error': ANSWER_GENERATION_ERROR, 'done': True})
+        return
+
+    yield _sse({
+        'query': query,
+        'source_documents_count': cached['source_documents_count'],
+        'status': 'success',
+        'done': True,
+    })
+
+
+# Cloud FunctionsのHTTPトリガーを定義
+@https_fn.on_request(secrets=["OPENAI_API_KEY"])  # ★ cors=CorsOptions(...) の引数を削除
+def rag_api_handler(request: https_fn.Request) -> tuple[https_fn.Response, int] | https_fn.Response:
+    # 1. OPTIONS (プリフライトリクエスト) のハンドリング
+    # LangChain / OpenAI 関連の処理に触れる前に、最初に応答して返す
+    if request.method == 'OPTIONS':
+        return create_response(
+            https_fn.Response('', status=HTTPStatus.NO_CONTENT)
+        )
+
+    # ★ 2. APIキーが存在しない場合のチェックと強制終了
+    openai_api_key = OPENAI_API_KEY.value
+    if not openai_api_key:
+        error_response = json_response({'error': 'OpenAI API Key (OPENAI_API_KEY) not set in environment.'})
+        # ★ エラー応答も必ず create_response を通し、CORSヘッダーを付与する
+        return create_response(error_response), HTTPStatus.INTERNAL_SERVER_ERROR
+
+    # 3. キャッシュ統計の参照 (GET /cache_stats)
+    if request.method == 'GET' and request.path.rstrip('/').endswith('/cache_stats'):
+        stats = _ANSWER_CACHE.stats()
+        return create_response(json_response(stats)), HTTPStatus.OK
+
+    # 4. リクエストから質問（query）を取得
+    # 不正なリクエストは LangChain 関連の処理に触れる前に 400 で返す
+    request_json = parse_json(request)
+    if not isinstance(request_json, dict):
+        error_response = json_response({'error': 'Request body must be a JSON object.'})
+        return create_response(error_response), HTTPStatus.BAD_REQUEST
+    user_query = request_json.get('prompt', 'Firebase FunctionsのRAGについて教えてください。')  # 'prompt'を使用
+    if not isinstance(user_query, str):
+        error_response = json_response({'error': "'prompt' must be a string."})
+        return create_response(error_response), HTTPStatus.BAD_REQUEST
+
+    # 複数質問の一括指定時 ('queries': [...]) は、すべての質問を並行して処理する
+    queries = request_json.get('queries')
+    if queries is not None:
+        if (not isinstance(queries, list) or not 0 < len(queries) <= MAX_BATCH_QUERIES
+                or not all(isinstance(query, str) for query in queries)):
+            error_response = json_response({'error': f"'queries' must be a list of 1 to {MAX_BATCH_QUERIES} strings."})
+            return create_response(error_response), HTTPStatus.BAD_REQUEST
+        results = _run_async(_answer_queries_async(openai_api_key, queries))
+        return create_response(json_response({'results': results, 'status': 'success'})), HTTPStatus.OK
+
+    # 5. 回答キャッシュの確認 (ヒットした場合は RAG を実行しない)
+    cached, rag_chain = _lookup_answer(openai_api_key, user_query)
+
+    # ストリーミング指定時 ('stream': true) は、生成途中の回答を SSE で逐次返す
+    if request_json.get('stream'):
+        stream_response = https_fn.Response(
+            _stream_answer(rag_chain, user_query, cached),
+            mimetype='text/event-stream',
+            headers={
+                'Cache-Control': 'no-cache',
+                # Cloud Run 側のプロキシでバッファリングさせない
+                'X-Accel-Buffering': 'no',
+            },
+        )
+        return create_response(stream_response)
+
+    if cached is None:
+        # 6. 実行と回答の取得 (検索は複数の検索元へ並列に問い合わせる)
+        try:
+            cached = _run_async(_generate_answer_async(rag_chain, user_query))
+        except AnswerError as e:
+            error_response = json_response({'error': e.error})
+            return create_response(error_response), e.status
 
-    # 9. 実行と回答の取得
-    response_txt = retrieval_chain.invoke({"input": user_query})
     responce_data = {
         'query': user_query,
-        'answer': response_txt['answer'],
-        # 参照元ドキュメント（今回はコード内のナレッジ）
-        'source_documents_count': len(response_txt['context']),
+        'answer': cached['answer'],
+        'source_documents_count': cached['source_documents_count'],
         'status': 'success'
     }
 
-    # 10. 結果の整形と返却
-    success_response = jsonify(responce_data)
+    # 7. 結果の整形と返却
+    success_response = json_response(responce_data)
     #終了
-    print(f"回答：{response_txt['answer']}")
-    print(f"応答終了")
+    logger.debug("回答：%s", cached['answer'])
+    logger.debug("応答終了")
     # create_response を適用し、ステータスコードと共に返す
-    return create_response(success_response), HTTPStatus.OK
\ No newline at end of file
+    return create_response(success_response), HTTPStatus.OK
@@ -0,0 +1,330 @@
+# main.py のテスト (OpenAI API には接続しない)
+#
+# 使い方 (venv 有効化後、functions ディレクトリで実行):
+#   pip install pytest
+#   python -m pytest -q
+
+import gc
+import os
+import weakref
+from http import HTTPStatus
+
+import httpx
+import numpy as np
+import openai
+import orjson
+import pytest
+from firebase_functions import https_fn
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding, FakeEmbeddings
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.prompts import ChatPromptTemplate
+from werkzeug.test import EnvironBuilder
+
+import main
+
+EMBEDDING_DIM = 8
+OPENAI_REQUEST = httpx.Request('POST', 'https://api.openai.com/v1/chat/completions')
+
+
+class TimeoutLLM:
+    """呼び出すたびに、OpenAI SDK のタイムアウト (APITimeoutError) を送出する LLM。"""
+
+    def __init__(self):
+        self.calls = 0
+
+    async def ainvoke(self, messages):
+        self.calls += 1
+        raise openai.APITimeoutError(request=OPENAI_REQUEST)
+
+
+class ScriptedLLM:
+    """質問文に応じて、決められた例外を送出するか固定の回答を返す LLM。"""
+
+    def __init__(self, errors: dict[str, Exception]):
+        self.errors = errors
+        self.calls = 0
+
+    async def ainvoke(self, messages):
+        self.calls += 1
+        for query, error in self.errors.items():
+            if query in messages[-1].content:
+                raise error
+        return AIMessage(content='回答')
+
+
+class StreamingLLM:
+    """決められたトークンを順に返し、指定があれば最後に例外を送出する LLM。"""
+
+    def __init__(self, tokens: list[str], error: Exception | None = None):
+        self.tokens = tokens
+        self.error = error
+
+    def stream(self, messages):
+        for token in self.tokens:
+            yield AIMessageChunk(content=token)
+        if self.error is not None:
+            raise self.error
+
+
+def _fake_chain(llm) -> main.RagChain:
+    """検索元を持たず、行が 1 つだけの RAG チェーンを生成する (LLM の呼び出しだけが行われる)。"""
+    return main.RagChain(
+        retrievers=[],
+        llm=llm,
+        prompt=ChatPromptTemplate.from_messages([("human", "コンテキスト: {context}\n質問: {input}")]),
+        embeddings=FakeEmbeddings(size=EMBEDDING_DIM),
+        lines=['テスト'],
+        line_doc_ids=np.array([0]),
+        line_section_ids=np.array([0]),
+        line_vectors=main._normalize(np.ones((1, EMBEDDING_DIM))),
+    )
+
+
+def _post(data: dict) -> https_fn.Request:
+    return https_fn.Request(EnvironBuilder(method='POST', json=data).get_environ())
+
+
+def _post_raw(body: bytes) -> https_fn.Request:
+    return https_fn.Request(EnvironBuilder(method='POST', data=body, content_type='application/json').get_environ())
+
+
+@pytest.fixture
+def no_chain(monkeypatch):
+    """RAG チェーンに触れずに応答することを確認する (チェーンを取得しようとしたら失敗させる)。"""
+    def get_chain(api_key):
+        raise AssertionError('RAG chain should not be built')
+
+    monkeypatch.setattr(main, '_get_chain', get_chain)
+    monkeypatch.setenv('OPENAI_API_KEY', 'test-key')
+
+
+@pytest.fixture
+def retry_delays(monkeypatch) -> list[float]:
+    """リトライの待機を省略し、待機しようとした秒数を記録する。"""
+    delays: list[float] = []
+
+    async def sleep(delay):
+        delays.append(delay)
+
+    monkeypatch.setattr(main.asyncio, 'sleep', sleep)
+    monkeypatch.setenv('OPENAI_API_KEY', 'test-key')
+    return delays
+
+
+def test_llm_timeout_is_retried_then_returns_504(monkeypatch, retry_delays):
+    llm = TimeoutLLM()
+    monkeypatch.setattr(main, '_lookup_answer', lambda api_key, query: (None, _fake_chain(llm)))
+
+    response, status = main.rag_api_handler(_post({'prompt': 'タイムアウトする質問'}))
+
+    assert llm.calls == 1 + len(main.ANSWER_RETRY_DELAYS)
+    assert retry_delays == list(main.ANSWER_RETRY_DELAYS)
+    assert status == HTTPStatus.GATEWAY_TIMEOUT
+    assert response.get_json() == {'error': main.ANSWER_TIMEOUT_ERROR}
+    assert response.headers['Access-Control-Allow-Origin'] == '*'
+
+
+def test_failed_query_does_not_fail_the_batch(monkeypatch, retry_delays):
+    rate_limited = openai.RateLimitError(
+        'Rate limit reached', response=httpx.Response(429, request=OPENAI_REQUEST), body=None
+    )
+    llm = ScriptedLLM({
+        '制限される質問': rate_limited,
+        'タイムアウトする一括の質問': openai.APITimeoutError(request=OPENAI_REQUEST),
+    })
+    monkeypatch.setattr(main, '_lookup_answer', lambda api_key, query: (None, _fake_chain(llm)))
+    queries = ['回答できる一括の質問', '制限される質問', 'タイムアウトする一括の質問']
+
+    response, status = main.rag_api_handler(_post({'queries': queries}))
+
+    assert status == HTTPStatus.OK
+    results = response.get_json()['results']
+    assert [result['query'] for result in results] == queries
+    assert [result['status'] for result in results] == ['success', 'error', 'error']
+    assert results[0]['answer'] == '回答'
+    assert results[1]['error'] == main.ANSWER_GENERATION_ERROR
+    assert results[2]['error'] == main.ANSWER_TIMEOUT_ERROR
+
+
+def test_openai_error_on_single_prompt_returns_502(monkeypatch, retry_delays):
+    rate_limited = openai.RateLimitError(
+        'Rate limit reached', response=httpx.Response(429, request=OPENAI_REQUEST), body=None
+    )
+    llm = ScriptedLLM({'制限される単一の質問': rate_limited})
+    monkeypatch.setattr(main, '_lookup_answer', lambda api_key, query: (None, _fake_chain(llm)))
+
+    response, status = main.rag_api_handler(_post({'prompt': '制限される単一の質問'}))
+
+    assert status == HTTPStatus.BAD_GATEWAY
+    assert response.get_json() == {'error': main.ANSWER_GENERATION_ERROR}
+    assert response.headers['Access-Control-Allow-Origin'] == '*'
+    assert retry_delays == []
+
+
+class FailingEmbeddings(FakeEmbeddings):
+    """呼び出されたら失敗する Embeddings (ベクトル化が行われないことの確認用)。"""
+
+    def embed_query(self, text: str) -> list[float]:
+        raise AssertionError('embed_query should not be called')
+
+
+def test_disabled_compression_skips_query_embedding():
+    rag_chain = _fake_chain(ScriptedLLM({}))._replace(embeddings=FailingEmbeddings(size=EMBEDDING_DIM), line_vectors=None)
+
+    answer, context = main._run_async(main._answer_async(rag_chain, '圧縮しない質問'))
+
+    assert answer == '回答'
+    assert context == []
+
+
+def test_compression_keeps_whole_section_when_only_a_header_matches(monkeypatch):
+    monkeypatch.setitem(main.CONTEXT_SIMILARITY_THRESHOLDS, 'fastembed', 0.5)
+    monkeypatch.setitem(main.CONTEXT_SIMILARITY_THRESHOLDS, 'openai', 0.5)
+    lines = [line for _, line in main.LINES]
+    # 質問と似ているのは見出し「〈経歴〉」だけで、年ごとの経歴の行は似ていないものとする
+    query_vector, unrelated = np.eye(EMBEDDING_DIM)[:2]
+    line_vectors = np.tile(unrelated, (len(lines), 1))
+    line_vectors[lines.index('〈経歴〉')] = query_vector
+    rag_chain = _fake_chain(None)._replace(
+        lines=lines,
+        line_doc_ids=np.array([doc_id for doc_id, _ in main.LINES]),
+        line_section_ids=np.array(main.LINE_SECTION_IDS),
+        line_vectors=line_vectors,
+    )
+
+    compressed = main._compress_context(rag_chain, list(query_vector), [Document(page_content=doc) for doc in main.DOCS])
+
+    content = "\n".join(doc.page_content for doc in compressed)
+    assert '【IT分野】' in content
+    assert '2015 中企業の塾講師 (大学中退)' in content
+    assert '2025 同じ会社内のチーム内 異動 アーキテクト専攻へ切り替え予定' in content
+    assert '【芸術分野】' not in content
+
+
+class CachedFakeEmbeddings(main._QueryEmbeddingCacheMixin, FakeEmbeddings):
+    """質問文のベクトルをキャッシュする FakeEmbeddings (呼び出すたびに乱数のベクトルを返す)。"""
+
+
+def test_query_embedding_cache_is_per_instance():
+    embeddings = CachedFakeEmbeddings(size=EMBEDDING_DIM)
+    other = CachedFakeEmbeddings(size=EMBEDDING_DIM)
+
+    assert embeddings.embed_query('年齢は？') == embeddings.embed_query('年齢は？')
+    assert other.embed_query('年齢は？') != embeddings.embed_query('年齢は？')
+
+    # キャッシュがインスタンスを参照し続けないこと (チェーンを作り直したら古いモデルは解放される)
+    ref = weakref.ref(embeddings)
+    del embeddings
+    gc.collect()
+    assert ref() is None
+
+
+def test_index_saved_by_another_process_is_not_deleted(monkeypatch, tmp_path):
+    monkeypatch.setattr(main, 'INDEX_CACHE_DIR', str(tmp_path))
+    path = main._index_dir(main.DOCS)
+    # 読み込みの確認後に、別のプロセスが索引を保存し終えたものとする
+    os.makedirs(path)
+    marker = os.path.join(path, 'saved-by-another-process')
+    open(marker, 'w').close()
+
+    vectorstore = main._load_or_build_vectorstore(main.DOCS, DeterministicFakeEmbedding(size=EMBEDDING_DIM))
+
+    assert vectorstore.index.ntotal == len(main.DOCS)
+    assert os.path.exists(marker)
+    assert os.listdir(tmp_path) == [os.path.basename(path)]
+
+
+@pytest.mark.parametrize('body, error', [
+    (b'', 'Request body must be a JSON object.'),
+    (b'{"prompt": ', 'Request body must be a JSON object.'),
+    ('["年齢は？"]'.encode(), 'Request body must be a JSON object.'),
+    (b'{"prompt": 28}', "'prompt' must be a string."),
+])
+def test_malformed_request_returns_400(no_chain, body, error):
+    response, status = main.rag_api_handler(_post_raw(body))
+
+    assert status == HTTPStatus.BAD_REQUEST
+    assert response.get_json() == {'error': error}
+    assert response.headers['Access-Control-Allow-Origin'] == '*'
+
+
+@pytest.mark.parametrize('queries', [
+    '年齢は？',
+    [],
+    ['年齢は？', 28],
+    ['年齢は？'] * (main.MAX_BATCH_QUERIES + 1),
+])
+def test_invalid_queries_return_400(no_chain, queries):
+    response, status = main.rag_api_handler(_post({'queries': queries}))
+
+    assert status == HTTPStatus.BAD_REQUEST
+    assert response.get_json() == {'error': f"'queries' must be a list of 1 to {main.MAX_BATCH_QUERIES} strings."}
+    assert response.headers['Access-Control-Allow-Origin'] == '*'
+
+
+def test_repeated_prompt_is_answered_from_cache(monkeypatch):
+    monkeypatch.setenv('OPENAI_API_KEY', 'test-key')
+    llm = ScriptedLLM({})
+    rag_chain = _fake_chain(llm)
+    monkeypatch.setattr(main, '_get_chain', lambda api_key: rag_chain)
+    before = main._ANSWER_CACHE.stats()
+
+    first, _ = main.rag_api_handler(_post({'prompt': 'キャッシュされる質問'}))
+    # 前後の空白・大文字小文字の違いは同じ質問として扱う
+    second, status = main.rag_api_handler(_post({'prompt': '  キャッシュされる質問  '}))
+
+    assert status == HTTPStatus.OK
+    assert llm.calls == 1
+    assert second.get_json()['answer'] == first.get_json()['answer'] == '回答'
+
+    stats_response, stats_status = main.rag_api_handler(
+        https_fn.Request(EnvironBuilder(method='GET', path='/cache_stats').get_environ())
+    )
+    stats = stats_response.get_json()
+    assert stats_status == HTTPStatus.OK
+    assert stats['hits'] == before['hits'] + 1
+    assert stats['misses'] == before['misses'] + 1
+    assert stats['size'] == before['size'] + 1
+    assert stats_response.headers['Access-Control-Allow-Origin'] == '*'
+
+
+def _sse_frames(response: https_fn.Response) -> list[dict]:
+    """SSE の応答を 1 フレームずつ JSON として読み出す。"""
+    frames = response.get_data().split(b"\n\n")
+    assert frames.pop() == b""
+    assert all(frame.startswith(b"data: ") for frame in frames)
+    return [orjson.loads(frame.removeprefix(b"data: ")) for frame in frames]
+
+
+def test_stream_sends_tokens_then_a_final_frame(monkeypatch):
+    monkeypatch.setenv('OPENAI_API_KEY', 'test-key')
+    monkeypatch.setattr(main, 'STREAM_FLUSH_INTERVAL', 0)
+    llm = StreamingLLM(['こん', 'にちは'])
+    monkeypatch.setattr(main, '_lookup_answer', lambda api_key, query: (None, _fake_chain(llm)))
+
+    response = main.rag_api_handler(_post({'prompt': 'ストリーミングの質問', 'stream': True}))
+
+    assert response.mimetype == 'text/event-stream'
+    assert response.headers['Access-Control-Allow-Origin'] == '*'
+    assert _sse_frames(response) == [
+        {'answer': 'こん'},
+        {'answer': 'にちは'},
+        {'query': 'ストリーミングの質問', 'source_documents_count': 0, 'status': 'success', 'done': True},
+    ]
+
+
+def test_stream_failure_sends_an_error_frame(monkeypatch):
+    monkeypatch.setenv('OPENAI_API_KEY', 'test-key')
+    monkeypatch.setattr(main, 'STREAM_FLUSH_INTERVAL', 0)
+    llm = StreamingLLM(['途中まで'], error=openai.APITimeoutError(request=OPENAI_REQUEST))
+    monkeypatch.setattr(main, '_lookup_answer', lambda api_key, query: (None, _fake_chain(llm)))
+
+    response = main.rag_api_handler(_post({'prompt': '途中で失敗する質問', 'stream': True}))
+
+    assert _sse_frames(response) == [
+        {'answer': '途中まで'},
+        {'query': '途中で失敗する質問', 'status': 'error', 'error': main.ANSWER_GENERATION_ERROR, 'done': True},
+    ]
+    # 失敗した回答はキャッシュしない
+    assert main._ANSWER_CACHE.get('途中で失敗する質問') is None